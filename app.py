@@ -1,20 +1,28 @@
 import os
+import hmac
+import hashlib
 import secrets
+import threading
+import time
 import requests
 from functools import wraps
-from flask import Flask, render_template, request, jsonify, abort, Response, url_for, session, redirect
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from flask import Flask, render_template, request, jsonify, abort, Response, url_for, session, redirect, g
 from flask_session import Session
-from math import ceil, floor, log
+from flask_caching import Cache
+from math import ceil
 from webdav3.client import Client
 from urllib.parse import quote, unquote, urlparse
 
 # --- Import from centralized config ---
-from config import load_config, validate_config
-from mail_processor import process_emails
+from config import load_config, validate_config, DEFAULT_CHUNK_SIZE, UPLOAD_SKIP_DUPLICATES
+from mail_processor import process_emails, DIGEST_SUFFIX
 
 # 导入from database
-from database import get_logs_paginated, get_total_log_count, get_log_count_by_status, get_db_connection, init_db, \
-    cleanup_stale_locks, get_config_value, set_config_value, seed_servers_from_env, \
+from database import get_logs_paginated, get_logs_after, get_logs_before, get_total_log_count, get_dashboard_stats, get_db_connection, init_db, \
+    get_config_value, set_config_value, seed_servers_from_env, \
     get_all_servers, get_enabled_servers, get_server_by_name, get_server_by_id, add_server, update_server, delete_server
 
 # 使用统一的日志模块
@@ -34,6 +42,14 @@ app.config['SESSION_USE_SIGNER'] = True
 # 初始化 Flask-Session
 Session(app)
 
+# 页面缓存（进程内）：仪表盘/日志页被反复刷新时直接返回已渲染的 HTML，不再查库和渲染模板
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 15})
+
+
+def page_cache_key():
+    """页面缓存键：按登录用户和完整请求路径（含查询参数）区分"""
+    return f"page:{session.get('username', '')}:{request.full_path}"
+
 # Load Config
 config = load_config()
 
@@ -42,12 +58,28 @@ config = load_config()
 # WEBDAV_SERVERS = config['webdav_servers']
 
 # ================= 初始化数据库 =================
-try:
-    init_db()
-    cleanup_stale_locks()  # 启动时无条件清理所有锁（新实例，旧锁无效）
-    seed_servers_from_env()  # 从环境变量导入服务器配置（首次启动）
-except Exception as e:
-    logger.error(f"{LogEmoji.ERROR} 数据库初始化失败: {e}")
+# 初始化推迟到本进程的第一个请求，导入模块（冷启动、gunicorn --preload）时不再访问数据库
+_bootstrapped = False
+_bootstrap_lock = threading.Lock()
+
+
+@app.before_request
+def _bootstrap_once():
+    """每个进程只执行一次：建表、从环境变量导入服务器"""
+    global _bootstrapped
+    if _bootstrapped:
+        return
+    with _bootstrap_lock:
+        if _bootstrapped:
+            return
+        try:
+            init_db()
+            seed_servers_from_env()  # 从环境变量导入服务器配置（已导入过则直接跳过）
+        except Exception as e:
+            logger.error(f"{LogEmoji.ERROR} 数据库初始化失败: {e}")
+        finally:
+            # 失败也不在每个请求上重试，与原先导入时只尝试一次的行为一致
+            _bootstrapped = True
 
 
 # --- 配置验证 ---
@@ -69,15 +101,52 @@ def validate_api_keys():
 validate_api_keys()
 
 
+# --- 请求级数据库连接 ---
+def get_request_db():
+    """获取当前请求共享的数据库连接，同一请求内的多次查询复用同一个池化连接。"""
+    if 'db' not in g:
+        g.db = get_db_connection()
+    return g.db
+
+
+@app.teardown_request
+def release_request_db(exc):
+    """请求结束时将共享连接归还连接池。"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.close()
+
+
 # --- 认证 ---
+def _credential_digest(value):
+    """计算凭据的 SHA-256 摘要，使比较双方长度固定，不泄露凭据长度。"""
+    return hashlib.sha256((value or '').encode('utf-8')).digest()
+
+
+# 启动时预先计算期望凭据的摘要
+_WEB_USER_DIGEST = _credential_digest(config['web']['user'])
+_WEB_PASS_DIGEST = _credential_digest(config['web']['password'])
+
+
 def check_auth(username, password):
     """检查用户名和密码是否正确,使用时序攻击安全的比较。"""
-    web_user = config['web']['user']
-    web_pass = config['web']['password']
+    # 比较定长摘要，并用 & 代替 and，确保用户名错误时密码比较依然执行
+    user_ok = hmac.compare_digest(_credential_digest(username), _WEB_USER_DIGEST)
+    pass_ok = hmac.compare_digest(_credential_digest(password), _WEB_PASS_DIGEST)
+    return user_ok & pass_ok
+
 
-    # 使用 secrets.compare_digest 防止时序攻击
-    return (secrets.compare_digest(username, web_user) and
-            secrets.compare_digest(password, web_pass))
+# 启动时预先构造 API 的期望 Authorization 头（bytes），请求时做常量时间比较
+_EXPECTED_EXTERNAL_AUTH = b"Bearer " + config['api']['secret_key'].encode('utf-8')
+_EXPECTED_INTERNAL_AUTH = b"Bearer " + config['api']['internal_key'].encode('utf-8')
+
+
+def check_bearer(expected):
+    """校验请求的 Bearer Token，使用时序攻击安全的比较。"""
+    auth_header = request.headers.get('Authorization')
+    if not auth_header:
+        return False
+    return hmac.compare_digest(auth_header.encode('utf-8'), expected)
 
 
 def authenticate():
@@ -99,33 +168,117 @@ def requires_auth(f):
 
 
 # --- WebDAV 辅助函数 ---
+# 服务器配置缓存: {名称: (过期时间, 配置)}。缓存只在本进程内有效：本进程增删改服务器时立即清空，
+# 其他实例（如 Vercel 上的其他函数实例）的修改最多 SERVER_CACHE_TTL 秒后生效；查不到的服务器不缓存
+SERVER_CACHE_TTL = 30
+SERVER_CACHE_MAXSIZE = 64
+_server_cache = {}
+_server_cache_lock = threading.Lock()
+
+
+def invalidate_server_cache():
+    """服务器配置发生变化后调用，令进程内的服务器配置缓存失效"""
+    with _server_cache_lock:
+        _server_cache.clear()
+    cache.clear()  # 仪表盘中的启用服务器数量随之变化
+
+
 def get_server_config(server_name):
-    """根据名称获取服务器配置（从数据库）"""
+    """根据名称获取服务器配置（进程内缓存 SERVER_CACHE_TTL 秒，本进程修改服务器后立即失效）"""
+    now = time.monotonic()
+    entry = _server_cache.get(server_name)
+    if entry is not None and now < entry[0]:
+        return entry[1]
+
+    server_config = _load_server_config(server_name)
+    if server_config is not None:
+        with _server_cache_lock:
+            if len(_server_cache) >= SERVER_CACHE_MAXSIZE:
+                _server_cache.clear()
+            _server_cache[server_name] = (now + SERVER_CACHE_TTL, server_config)
+    return server_config
+
+
+def _load_server_config(server_name):
+    """从数据库读取服务器配置"""
     server = get_server_by_name(server_name)
     if server:
-        # 转换数据库格式为应用所需格式
+        # 转换数据库格式为应用所需格式，并预先拆分 URL，避免每个请求重复 urlparse
+        host, root_path = split_webdav_url(server['url'])
         return {
             'name': server['name'],
             'url': server['url'],
             'login': server['login'],
             'password': server['password'],
             'timeout': server.get('timeout', 60),
-            'chunk_size': server.get('chunk_size', 8192)
+            'chunk_size': server.get('chunk_size', DEFAULT_CHUNK_SIZE),
+            'host': host,
+            'root_path': root_path
         }
     return None
 
+
+def split_webdav_url(url):
+    """将 WebDAV URL 拆分为 (scheme://netloc, 去掉末尾斜杠的根路径)"""
+    parsed_url = urlparse(url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}", parsed_url.path.rstrip('/')
+
+# 浏览目录时隐藏的系统文件
+_IGNORED_NAMES = frozenset({'.DS_Store', '._.DS_Store', 'Thumbs.db'})
+# 目录列表排序键，构建条目时已预先计算
+_BY_SORT_KEY = itemgetter('_sort_key')
+
+# 按服务器缓存的 HTTP 会话和 WebDAV 客户端，保持 keep-alive 连接，避免每次浏览/下载重新 TCP+TLS 握手
+_webdav_sessions = {}
+_webdav_clients = {}
+_webdav_pool_lock = threading.Lock()
+
+
+def get_requests_session(server_name):
+    """获取指定服务器共享的 requests.Session（带连接池）"""
+    with _webdav_pool_lock:
+        session = _webdav_sessions.get(server_name)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _webdav_sessions[server_name] = session
+    return session
+
+
 def get_webdav_client(server_config):
-    """获取WebDAV客户端实例"""
-    parsed_url = urlparse(server_config['url'])
-    host = f"{parsed_url.scheme}://{parsed_url.netloc}"
-    root_path = parsed_url.path.rstrip('/')
-    
-    return Client({
+    """获取WebDAV客户端实例（按服务器复用，连接参数变化时重建）"""
+    server_name = server_config.get('name', server_config['url'])
+    signature = (server_config['url'], server_config['login'], server_config['password'])
+
+    with _webdav_pool_lock:
+        cached = _webdav_clients.get(server_name)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    if 'host' in server_config:
+        host, root_path = server_config['host'], server_config['root_path']
+    else:
+        host, root_path = split_webdav_url(server_config['url'])
+
+    client = Client({
         'webdav_hostname': host,
         'webdav_login': server_config['login'],
         'webdav_password': server_config['password'],
         'webdav_root': root_path
     })
+    client.session = get_requests_session(server_name)
+
+    with _webdav_pool_lock:
+        _webdav_clients[server_name] = (signature, client)
+    return client
+
+# 文件大小单位及对应除数 (1024 的幂)
+_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+_SIZE_DIVISORS = tuple(1 << (10 * i) for i in range(len(_SIZE_UNITS)))
+_SIZE_MAX_INDEX = len(_SIZE_UNITS) - 1
+
 
 def format_size(size_bytes):
     """将字节转换为KB、MB、GB等。"""
@@ -135,11 +288,11 @@ def format_size(size_bytes):
         size_bytes = int(size_bytes)
         if size_bytes == 0:
             return "0B"
-        size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-        i = int(floor(log(size_bytes, 1024)))
-        p = pow(1024, i)
-        s = round(size_bytes / p, 2)
-        return f"{s} {size_name[i]}"
+        if size_bytes < 0:
+            return "-"
+        # 单位下标即 floor(log1024(n))，用整数位长度计算，避免浮点对数运算
+        i = min((size_bytes.bit_length() - 1) // 10, _SIZE_MAX_INDEX)
+        return f"{round(size_bytes / _SIZE_DIVISORS[i], 2)} {_SIZE_UNITS[i]}"
     except (ValueError, TypeError):
         return "-"
 
@@ -197,16 +350,18 @@ def logout():
 # === 页面路由 ===
 @app.route('/')
 @requires_auth
+@cache.cached(timeout=30, key_prefix=page_cache_key)
 def home():
-    # Fetch dashboard stats
-    total_logs = get_total_log_count()
-    success_count = get_log_count_by_status('Success')
-    enabled_servers = len(get_enabled_servers())
+    # Fetch dashboard stats (一条聚合查询 + 一条服务器查询，共享请求级连接)
+    conn = get_request_db()
+    total_logs, success_count, skipped_count = get_dashboard_stats(conn=conn)
+    enabled_servers = len(get_enabled_servers(conn=conn))
     
-    # Calculate success rate
+    # Calculate success rate（内容重复而跳过的记录既不算成功也不算失败）
     success_rate = 0
-    if total_logs > 0:
-        success_rate = int((success_count / total_logs) * 100)
+    attempted = total_logs - skipped_count
+    if attempted > 0:
+        success_rate = int((success_count / attempted) * 100)
         
     return render_template('index.html', 
                          total_logs=total_logs,
@@ -216,25 +371,45 @@ def home():
 
 @app.route('/logs')
 @requires_auth
+@cache.cached(timeout=10, key_prefix=page_cache_key)
 def view_logs():
     """
     從資料庫獲取分頁日誌並顯示，支持搜索。
+
+    「下一页」/「上一页」分别携带 after_id / before_id 游标（keyset 分页），直接跳页时才使用 OFFSET。
     """
     page = request.args.get('page', 1, type=int)
+    after_id = request.args.get('after_id', type=int)
+    before_id = request.args.get('before_id', type=int)
     search_query = request.args.get('q', None)
     per_page = 20
 
-    logs = get_logs_paginated(page, per_page, search_query)
-    total_logs = get_total_log_count(search_query)
-    total_pages = ceil(total_logs / per_page)
+    conn = get_request_db()
+    # 多取一行用于判断是否存在下一页，无需额外 COUNT
+    if before_id is not None:
+        logs = get_logs_before(before_id, per_page, search_query, conn=conn)
+        has_next = bool(logs)  # 游标 before_id 所在的行就在本页之后
+    else:
+        if after_id is not None:
+            logs = get_logs_after(after_id, per_page, search_query, lookahead=True, conn=conn)
+        else:
+            logs = get_logs_paginated(page, per_page, search_query, lookahead=True, conn=conn)
+        has_next = len(logs) > per_page
+        logs = logs[:per_page]
+
+    # 仅无搜索条件时展示页码（总数有缓存）；搜索结果只提供上一页/下一页
+    total_pages = None
+    if not search_query:
+        total_pages = ceil(get_total_log_count(conn=conn) / per_page)
 
-    # 將檔案大小從字節轉換為更易讀的格式
-    for log in logs:
-        log['size_readable'] = format_size(log['size_bytes'])
+    # 易读的文件大小 (size_readable) 已由 SQL 查询直接生成
 
     return render_template('logs.html',
                            logs=logs,
                            page=page,
+                           has_next=has_next,
+                           next_after_id=logs[-1]['id'] if logs else None,
+                           prev_before_id=logs[0]['id'] if logs else None,
                            total_pages=total_pages,
                            search_query=search_query)
 
@@ -282,54 +457,58 @@ def webdav_index(subpath=None):
         items = client.list(req_path, get_info=True)
         
         # 获取 WebDAV Root Path 用于路径处理
-        parsed_url = urlparse(server_config['url'])
-        webdav_root_path = parsed_url.path.rstrip('/')
+        webdav_root_path = server_config['root_path']
         
+        # 循环不变量提前计算：当前目录的完整路径（用于过滤目录自身）和根路径长度
+        # 条目路径统一按解码后的形式处理，根路径也解码一次以便比较
+        webdav_root_path = unquote(webdav_root_path)
+        current_full_path = (webdav_root_path + req_path).replace('//', '/').rstrip('/')
+        webdav_root_len = len(webdav_root_path)
+
         file_list = []
         for item in items:
-            item_full_path = item['path']
-            
-            # 构造当前目录的完整路径来比较，过滤掉当前目录本身
-            current_full_path = webdav_root_path + req_path
-            current_full_path = current_full_path.replace('//', '/')
-            
-            if item_full_path.rstrip('/') == current_full_path.rstrip('/'):
-                continue
-                
-            # 计算显示路径 (相对于 WebDAV Root)
-            if webdav_root_path and item_full_path.startswith(webdav_root_path):
-                rel_path = item_full_path[len(webdav_root_path):]
-            else:
-                rel_path = item_full_path
-            
-            if not rel_path.startswith('/'):
-                rel_path = '/' + rel_path
-                
-            # 最终显示路径需要包含 server_name 前缀: /files/<server_name>/<rel_path>
-            # 但在模板中 url_for 会自动处理，我们只需要给 webdav_index 传 subpath
-            # subpath = server_name + rel_path
-            # 这里我们为了方便模板，直接构造完整的 subpath
-            
-            display_subpath = f"{server_name}{rel_path}"
+            # 路径只解码一次，名称、黑名单检查和显示路径都基于解码结果
+            decoded_path = unquote(item['path'])
+            item_path = decoded_path.rstrip('/')
 
-            name = os.path.basename(item_full_path.rstrip('/'))
-            if not name: 
+            # 过滤掉当前目录本身
+            if item_path == current_full_path:
                 continue
-            
-            # 过滤系统文件
-            if name in ['.DS_Store', '._.DS_Store']:
+
+            name = item_path.rpartition('/')[2]
+            # 过滤空名称和系统文件
+            if not name or name in _IGNORED_NAMES:
                 continue
 
+            # 计算显示路径 (相对于 WebDAV Root)，模板直接把 <server_name><rel_path> 作为 subpath 传给 url_for
+            rel_path = decoded_path
+            if webdav_root_len and rel_path.startswith(webdav_root_path):
+                rel_path = rel_path[webdav_root_len:]
+            if rel_path[:1] != '/':
+                rel_path = '/' + rel_path
+
+            isdir = item['isdir']
+            size = item.get('size')
             file_list.append({
-                'name': unquote(name),
-                'display_path': display_subpath, # 传递给 url_for('webdav_index', subpath=...)
-                'isdir': item['isdir'],
-                'size_str': format_size(item.get('size', 0)) if not item['isdir'] else '-',
+                'name': name,
+                'display_path': f"{server_name}{rel_path}", # 传递给 url_for('webdav_index', subpath=...)
+                'isdir': isdir,
+                'size_str': '-' if isdir else format_size(size),
                 'mtime': format_date(item.get('modified', '')),
-                'size': int(item.get('size', 0)) if not item['isdir'] and item.get('size') else 0
+                'size': int(size) if not isdir and size else 0,
+                '_sort_key': (0 if isdir else 1, name.lower())  # 目录在前，再按名称排序
             })
 
-        file_list.sort(key=lambda x: (not x['isdir'], x['name'].lower()))
+        if UPLOAD_SKIP_DUPLICATES:
+            # 隐藏重复检测用的摘要文件：只隐藏同一目录中存在对应原文件的 '<文件名>.sha256'
+            names = {entry['name'] for entry in file_list}
+            file_list = [
+                entry for entry in file_list
+                if entry['isdir'] or not entry['name'].endswith(DIGEST_SUFFIX)
+                or entry['name'][:-len(DIGEST_SUFFIX)] not in names
+            ]
+
+        file_list.sort(key=_BY_SORT_KEY)
         
         # 计算父目录
         if req_path == '/':
@@ -366,9 +545,8 @@ def webdav_download(subpath):
     if not server_config:
         return "Server not found", 404
         
-    parsed_url = urlparse(server_config['url'])
-    webdav_host = f"{parsed_url.scheme}://{parsed_url.netloc}"
-    webdav_root_path = parsed_url.path.rstrip('/')
+    webdav_host = server_config['host']
+    webdav_root_path = server_config['root_path']
 
     # 尝试解码路径，解决部分服务器/客户端编码不一致问题
     req_path_decoded = unquote(req_path)
@@ -377,63 +555,47 @@ def webdav_download(subpath):
 
     # 优先使用解码后的路径，如果失败则尝试原始路径
     target_path = req_path_decoded
-    
-    full_webdav_path = webdav_root_path + target_path
-    full_webdav_path = full_webdav_path.replace('//', '/')
-
-    try:
-        # 1. 获取文件元数据 (准确的大小和修改时间)
-        # 注意: 即使获取失败也继续尝试下载，因为 info 可能因为权限等原因失败但 get 成功
-        file_size = None
-        last_modified = None
-        
-        client = get_webdav_client(server_config)
-        try:
-            info = client.info(target_path)
-            file_size = int(info.get('size', 0))
-            last_modified = info.get('modified')
-        except Exception as e:
-            logger.warning(f"{LogEmoji.WARNING} 获取文件信息失败 (尝试继续下载): {e}, Path: {target_path}")
-            # 备选：尝试使用未解码的路径
-            if req_path != req_path_decoded:
-                try:
-                    logger.info(f"尝试使用原始路径获取信息: {req_path}")
-                    info = client.info(req_path)
-                    file_size = int(info.get('size', 0))
-                    last_modified = info.get('modified')
-                    target_path = req_path # 如果原始路径成功，下载也用原始路径
-                    full_webdav_path = webdav_root_path + target_path
-                    full_webdav_path = full_webdav_path.replace('//', '/')
-                except Exception as e2:
-                    logger.warning(f"{LogEmoji.WARNING} 原始路径获取信息也失败: {e2}")
 
-        
-        # 2. 构建下载链接
-        encoded_path = quote(full_webdav_path, safe='/')
-        file_url = f"{webdav_host}{encoded_path}"
-        
-        # 3. 发起请求 (流式下载)
-        headers = {'User-Agent': 'WebDAV-Browser'}
-        upstream_res = requests.get(
+    def open_upstream(path):
+        """对指定路径发起流式 GET 请求"""
+        full_webdav_path = (webdav_root_path + path).replace('//', '/')
+        file_url = f"{webdav_host}{quote(full_webdav_path, safe='/')}"
+        return get_requests_session(server_name).get(
             file_url,
             auth=(server_config['login'], server_config['password']),
             stream=True,
-            headers=headers,
+            headers={'User-Agent': 'WebDAV-Browser'},
             timeout=server_config['timeout']
         )
-        
+
+    try:
+        # 1. 直接发起流式 GET，文件大小和修改时间取自响应头，省去单独的 PROPFIND(info) 往返
+        upstream_res = open_upstream(target_path)
+
+        # 备选：解码路径 404 时尝试使用未解码的原始路径
+        if upstream_res.status_code == 404 and req_path != req_path_decoded:
+            logger.info(f"解码路径不存在，尝试使用原始路径下载: {req_path}")
+            upstream_res.close()
+            target_path = req_path
+            upstream_res = open_upstream(target_path)
+
         # 检查响应状态，如果是错误页面(如404/500)，内容可能很短(比如12字节)
         if upstream_res.status_code != 200:
             logger.error(f"{LogEmoji.ERROR} WebDAV 下载响应错误: {upstream_res.status_code}")
+            upstream_res.close()
             return f"WebDAV Error: {upstream_res.status_code}", upstream_res.status_code
 
         def generate():
+            # 直接读取底层 urllib3 流，跳过 iter_content 的额外包装；
+            # decode_content=True 保证 gzip 等编码仍由 urllib3 解码
             try:
-                for chunk in upstream_res.iter_content(chunk_size=server_config['chunk_size']):
+                for chunk in upstream_res.raw.stream(server_config['chunk_size'], decode_content=True):
                     if chunk:
                         yield chunk
             except Exception as e:
                 logger.error(f"{LogEmoji.ERROR} 下载流中断: {e}")
+            finally:
+                upstream_res.close()
 
         filename = os.path.basename(target_path)
         try:
@@ -441,21 +603,23 @@ def webdav_download(subpath):
         except:
             filename_utf8 = filename
 
-        # 4. 构建响应头 (使用 info 中的准确信息)
+        # 2. 构建响应头 (透传上游的大小、类型和修改时间)
+        upstream_headers = upstream_res.headers
         resp_headers = {
             "Content-Disposition": f"attachment; filename*=UTF-8''{filename_utf8}",
-            "Content-Length": file_size,
-            "Content-Type": "application/octet-stream" # 默认类型
+            "Content-Type": upstream_headers.get('Content-Type', 'application/octet-stream')
         }
-        
-        # 尝试从 info 或 upstream headers 获取更准确的 Content-Type
-        if 'Content-Type' in upstream_res.headers:
-             resp_headers['Content-Type'] = upstream_res.headers['Content-Type']
-            
+
+        # 上游若经过 gzip 等压缩，Content-Length 是压缩后的长度，而我们输出的是解码后的内容，此时不能透传
+        file_size = upstream_headers.get('Content-Length')
+        if file_size and upstream_headers.get('Content-Encoding', 'identity') == 'identity':
+            resp_headers['Content-Length'] = file_size
+
+        last_modified = upstream_headers.get('Last-Modified')
         if last_modified:
-             resp_headers['Last-Modified'] = format_date(last_modified) # 确保格式正确
+            resp_headers['Last-Modified'] = last_modified  # 上游已是 HTTP 日期格式
         
-        return Response(generate(), headers=resp_headers)
+        return Response(generate(), headers=resp_headers, direct_passthrough=True)
         
     except Exception as e:
         logger.error(f"{LogEmoji.ERROR} WebDAV 下载失败: {str(e)}")
@@ -467,17 +631,14 @@ def run_task():
     """
     公开的 API 端点，用于异步触发邮件处理任务。
     """
-    # Reload config to ensure latest values
-    current_config = load_config()
-    api_secret_key = current_config['api']['secret_key']
-    internal_api_key = current_config['api']['internal_key']
+    api_secret_key = config['api']['secret_key']
+    internal_api_key = config['api']['internal_key']
 
     if not api_secret_key or not internal_api_key:
         return jsonify({"status": "error", "message": "Server Error: API keys 未完全配置。"}), 500
 
     # 验证外部 API 密钥
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or auth_header != f"Bearer {api_secret_key}":
+    if not check_bearer(_EXPECTED_EXTERNAL_AUTH):
         return jsonify({"status": "error", "message": "Unauthorized: 无效或缺失的 API 密钥。"}), 401
 
     try:
@@ -485,8 +646,10 @@ def run_task():
         worker_url = url_for('internal_worker', _external=True)
         headers = {'Authorization': f'Bearer {internal_api_key}'}
 
-        # 使用 timeout 实现 "fire-and-forget"
-        requests.post(worker_url, headers=headers, timeout=0.5)
+        # 使用较短的读超时实现 "fire-and-forget"：请求必须在本次调用返回前发出，
+        # 不能交给后台线程（Vercel 在响应返回后会冻结实例，线程中的请求可能永远发不出去）。
+        # 连接超时同样限制为 0.5 秒，触发端点最多阻塞约 1 秒
+        requests.post(worker_url, headers=headers, timeout=(0.5, 0.5))
 
     except requests.exceptions.ReadTimeout:
         # 这是预期的行为，因为我们不等待 worker 响应
@@ -502,15 +665,13 @@ def internal_worker():
     """
     内部 worker 端点，实际执行耗时任务。
     """
-    internal_api_key = config['api']['internal_key']
-
     # 验证内部 API 密钥
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or auth_header != f"Bearer {internal_api_key}":
+    if not config['api']['internal_key'] or not check_bearer(_EXPECTED_INTERNAL_AUTH):
         return jsonify({"status": "error", "message": "Unauthorized"}), 401
 
     try:
         process_emails()
+        cache.clear()  # 新的上传日志已写入，丢弃缓存的页面
         return jsonify({"status": "success"}), 200
     except Exception as e:
         # 记录详细错误但不暴露给客户端
@@ -574,6 +735,7 @@ def add_webdav_server():
             return jsonify({"status": "error", "message": f"服务器名称 '{name}' 已存在"}), 400
         
         if add_server(name, url, login, password, enabled, priority):
+            invalidate_server_cache()
             return jsonify({"status": "success", "message": f"服务器 '{name}' 添加成功"}), 200
         else:
             return jsonify({"status": "error", "message": "添加失败"}), 500
@@ -610,6 +772,7 @@ def edit_webdav_server(server_id):
                 return jsonify({"status": "error", "message": f"服务器名称 '{name}' 已被使用"}), 400
         
         if update_server(server_id, name, url, login, password, enabled, priority):
+            invalidate_server_cache()
             return jsonify({"status": "success", "message": f"服务器 '{name}' 更新成功"}), 200
         else:
             return jsonify({"status": "error", "message": "更新失败"}), 500
@@ -635,6 +798,7 @@ def delete_webdav_server(server_id):
             return jsonify({"status": "error", "message": "不能删除默认服务器，请先选择其他默认服务器"}), 400
         
         if delete_server(server_id):
+            invalidate_server_cache()
             return jsonify({"status": "success", "message": f"服务器 '{server['name']}' 删除成功"}), 200
         else:
             return jsonify({"status": "error", "message": "删除失败"}), 500
@@ -679,6 +843,52 @@ def test_webdav_server(server_id):
         }), 200  # 返回 200 但 status 为 error，方便前端处理
 
 
+# WebDAV 健康检查：单个服务器的超时（秒）和汇总结果的缓存时间（秒）
+HEALTH_CHECK_TIMEOUT = 2
+HEALTH_CACHE_TTL = 10
+_webdav_health_cache = (0.0, None)  # (过期时间, 状态)
+
+
+def _check_webdav_server(server):
+    """对服务器根目录发起 Depth: 0 的 PROPFIND，返回 (名称, 是否可用)"""
+    host, root_path = split_webdav_url(server['url'])
+    # 与 webdav_index 一致：先解码服务器 URL 中已编码的路径再编码，避免 %20 变成 %2520
+    root_path = unquote(root_path)
+    try:
+        res = get_requests_session(server['name']).request(
+            'PROPFIND',
+            f"{host}{quote(root_path or '/', safe='/')}",
+            auth=(server['login'], server['password']),
+            headers={'Depth': '0'},
+            timeout=HEALTH_CHECK_TIMEOUT
+        )
+        res.close()
+        if res.status_code >= 400:
+            raise requests.HTTPError(f"HTTP {res.status_code}")
+        return server['name'], True
+    except Exception as e:
+        logger.error(f"{LogEmoji.ERROR} WebDAV 健康检查失败 ({server['name']}): {e}")
+        return server['name'], False
+
+
+def get_webdav_health():
+    """并行检查所有配置的 WebDAV 服务器，耗时取决于最慢的一个而非总和"""
+    global _webdav_health_cache
+    expires_at, cached_status = _webdav_health_cache
+    if cached_status is not None and time.monotonic() < expires_at:
+        return cached_status
+
+    servers = config['webdav_servers']
+    webdav_status = "connected"
+    if servers:
+        with ThreadPoolExecutor(max_workers=min(8, len(servers))) as executor:
+            if not all(ok for _, ok in executor.map(_check_webdav_server, servers)):
+                webdav_status = "disconnected"
+
+    _webdav_health_cache = (time.monotonic() + HEALTH_CACHE_TTL, webdav_status)
+    return webdav_status
+
+
 @app.route('/health')
 def health_check():
     """健康检查端点,用于监控和自动化检测"""
@@ -688,11 +898,10 @@ def health_check():
         "webdav": "unknown"
     }
     
-    # 检查数据库连接
+    # 检查数据库连接（复用请求级连接，由 teardown 统一归还）
     try:
-        conn = get_db_connection()
+        conn = get_request_db()
         if conn:
-            conn.close()
             status["database"] = "connected"
         else:
             status["database"] = "disconnected"
@@ -702,17 +911,10 @@ def health_check():
         status["database"] = "error"
         status["status"] = "unhealthy"
 
-    # 检查 WebDAV 连接 (检查所有配置的服务器)
-    webdav_status = "connected"
-    for server in config['webdav_servers']:
-        try:
-            client = get_webdav_client(server)
-            client.list('/', get_info=False)
-        except Exception as e:
-            logger.error(f"{LogEmoji.ERROR} WebDAV 健康检查失败 ({server['name']}): {e}")
-            webdav_status = "disconnected"
-            status["status"] = "unhealthy"
-            
+    # 检查 WebDAV 连接 (并行检查所有配置的服务器，结果短时缓存)
+    webdav_status = get_webdav_health()
+    if webdav_status != "connected":
+        status["status"] = "unhealthy"
     status["webdav"] = webdav_status
 
     code = 200 if status["status"] == "healthy" else 503
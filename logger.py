@@ -58,6 +58,9 @@
     - Logger 实例会被缓存，避免重复创建
     - 字符串格式化使用 f-string，性能最优
     - 根 logger 只在模块导入时配置一次
+    - 各模块的 logger 不单独挂处理器，记录统一交给根 logger 输出一次
+    - 写 stdout 由后台线程（QueueListener）完成，记录日志的线程不阻塞在 I/O 上；
+      Serverless 环境（设置了 VERCEL）中直接同步写入，避免实例冻结时队列中的日志丢失
 
 注意事项:
     - 不要在日志中输出敏感信息（密码、密钥等）
@@ -69,9 +72,12 @@ Author: MailBridge Team
 Version: 1.0.0
 License: MIT
 """
+import atexit
 import os
+import queue
 import sys
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from typing import Optional
 
 # ==================== 配置常量 ====================
@@ -167,8 +173,8 @@ def setup_logging(
     
     配置内容:
         - 设置日志级别（从参数或环境变量）
-        - 创建控制台处理器（输出到 stdout）
-        - 设置日志格式
+        - 默认不创建处理器，记录传播到根 logger 统一输出
+        - 指定 format_str 时创建独立的控制台处理器，并停止向根 logger 传播
         - 避免重复配置（检查 handlers）
     
     Args:
@@ -184,7 +190,7 @@ def setup_logging(
     
     Note:
         - 如果 logger 已有 handlers，会跳过配置（避免重复）
-        - Handler 输出到 stdout，不输出到 stderr
+        - 输出到 stdout，不输出到 stderr
         - 同一个 name 多次调用会返回同一个实例（logging 模块特性）
     
     See Also:
@@ -200,19 +206,18 @@ def setup_logging(
     # 设置日志级别
     log_level = level if level is not None else get_log_level()
     logger.setLevel(log_level)
-    
-    # 创建控制台处理器（输出到 stdout）
+
+    # 默认格式由根 logger 的处理器输出；若这里再挂一个处理器，每条日志都会输出两次
+    if format_str is None:
+        return logger
+
+    # 自定义格式：单独的控制台处理器（输出到 stdout），不再传播到根 logger
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setLevel(log_level)
-    
-    # 设置日志格式
-    log_format = format_str if format_str is not None else get_log_format()
-    formatter = logging.Formatter(log_format)
-    console_handler.setFormatter(formatter)
-    
-    # 添加处理器到 logger
+    console_handler.setFormatter(logging.Formatter(format_str))
     logger.addHandler(console_handler)
-    
+    logger.propagate = False
+
     return logger
 
 
@@ -348,8 +353,11 @@ def configure_root_logger():
     
     配置内容:
         - 从环境变量读取日志级别
-        - 创建控制台处理器
-        - 设置日志格式
+        - 创建控制台处理器并设置日志格式
+        - 根 logger 上只挂 QueueHandler，控制台处理器由后台 QueueListener 线程调用，
+          并行上传等线程记录日志时只需入队
+        - Serverless 环境（设置了 VERCEL）中直接挂控制台处理器同步写入：响应返回后实例会被冻结，
+          atexit 也不会在两次调用之间执行，后台线程里尚未输出的日志会延迟甚至丢失
     
     Note:
         - 只配置一次（检查 handlers）
@@ -376,7 +384,17 @@ def configure_root_logger():
     formatter = logging.Formatter(get_log_format())
     console_handler.setFormatter(formatter)
     
-    root_logger.addHandler(console_handler)
+    if os.getenv("VERCEL"):
+        root_logger.addHandler(console_handler)
+        return
+    
+    # 写 stdout 交给后台线程；退出时 stop() 会先输出队列中剩余的日志
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    root_logger.addHandler(QueueHandler(log_queue))
 
 
 # 模块导入时自动配置根 logger
@@ -25,7 +25,7 @@
     
     4. 分布式锁
         - 防止并发处理同一邮件
-        - 超时自动释放
+        - 持锁连接断开或空闲超时后自动释放
         - 适配 Vercel 多实例环境
 
 业务流程:
@@ -52,7 +52,7 @@
     数据库:
         - webdav_servers: 服务器配置
         - app_config: 默认服务器设置
-        - app_locks: 分布式锁表
+        - MySQL 命名锁 (GET_LOCK): 防止并发执行
         - upload_logs: 上传日志
 
 使用示例:
@@ -96,19 +96,31 @@
 Author: MailBridge Team
 Version: 1.0.0
 """
-import errno
-import re
+import atexit
+import hashlib
+import signal
 import sys
-from typing import Dict, Any
-from urllib.parse import unquote
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Set, Tuple
+from urllib.parse import unquote, urlsplit
+from xml.etree import ElementTree
 import os
+import re
 
 import requests
 from imbox import Imbox
+from imbox.parser import parse_email
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
 
 # --- Import from centralized config ---
-from config import load_config, validate_config, MAX_ATTACHMENT_SIZE, MAX_EMAILS_PER_RUN
-from database import log_upload, acquire_lock, release_lock
+from config import load_config, validate_config, UploadServer, MAX_ATTACHMENT_SIZE, MAX_EMAILS_PER_RUN, \
+    UPLOAD_RETRY_COUNT, UPLOAD_RETRY_DELAY, UPLOAD_RETRY_JITTER, UPLOAD_WORKERS, UPLOAD_SKIP_DUPLICATES, \
+    WEBDAV_CHUNK_SIZE
+from database import get_db_connection, log_upload, flush_logs, acquire_lock, release_lock
 
 # 使用统一的日志模块
 from logger import get_logger, LogEmoji
@@ -116,14 +128,103 @@ from logger import get_logger, LogEmoji
 logger = get_logger(__name__)
 
 
+# ==================== HTTP 会话 ====================
+
+# 进程退出信号：置位后重试退避立即结束，处理循环不再开始新的邮件；每次运行开始时清除
+_SHUTDOWN = threading.Event()
+
+
+class _ShutdownAwareRetry(Retry):
+    """
+    退避等待用 _SHUTDOWN.wait 代替 time.sleep 的 urllib3 Retry。
+
+    故障期间多个上传线程可能同时处于退避中；收到退出信号后它们立即放弃重试，
+    而不是睡满整个退避时间。
+    """
+
+    def sleep(self, response=None) -> None:
+        delay = 0
+        if self.respect_retry_after_header and response:
+            delay = self.get_retry_after(response) or 0
+        if not delay:
+            delay = self.get_backoff_time()
+        if _SHUTDOWN.wait(max(delay, 0)):
+            raise MaxRetryError(None, None, reason=ConnectionAbortedError("Shutdown requested, retry aborted"))
+
+
+def _create_session() -> requests.Session:
+    """
+    创建 WebDAV 上传共用的 HTTP 会话
+
+    复用 keep-alive 连接，避免每个 HEAD/PUT/PROPFIND 都重新 TCP+TLS 握手；
+    连接错误和 429/502/503/504 由 urllib3 按指数退避自动重试（UPLOAD_RETRY_COUNT 次，
+    单次等待不超过 UPLOAD_RETRY_DELAY 秒，另加最多 UPLOAD_RETRY_JITTER 秒随机抖动；
+    429/503 带 Retry-After 时按服务器要求等待）。其他 4xx 不重试。
+    退避期间收到退出信号（_SHUTDOWN）会立即放弃剩余重试。
+    """
+    retry = _ShutdownAwareRetry(
+        total=UPLOAD_RETRY_COUNT,
+        backoff_factor=0.3,
+        backoff_max=UPLOAD_RETRY_DELAY,
+        backoff_jitter=UPLOAD_RETRY_JITTER,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'PROPFIND'},
+        raise_on_status=False,  # 重试用尽后返回最后一次响应，交给 raise_for_status 处理
+    )
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(8, UPLOAD_WORKERS), max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_SESSION = _create_session()
+atexit.register(_SESSION.close)
+
+
+def _install_shutdown_handlers() -> Dict[int, Any]:
+    """
+    在主线程中运行时接管 SIGINT/SIGTERM：先置位 _SHUTDOWN，再交给原来的处理器。
+
+    Ctrl-C 或 cron 超时发出的 SIGTERM 因此能打断上传线程中的重试退避。
+    原来被忽略（SIG_IGN）的信号仍然忽略，不会置位 _SHUTDOWN。
+    先清除上一次运行遗留的 _SHUTDOWN，再返回原处理器供运行结束后恢复；
+    不在主线程（如 Web 请求线程）时不接管信号。
+    """
+    _SHUTDOWN.clear()
+    if threading.current_thread() is not threading.main_thread():
+        return {}
+
+    previous = {}
+
+    def handler(signum, frame):
+        prev = previous.get(signum)
+        if prev == signal.SIG_IGN:
+            return
+        _SHUTDOWN.set()
+        if callable(prev):
+            prev(signum, frame)
+        else:
+            raise SystemExit(128 + signum)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        previous[signum] = signal.signal(signum, handler)
+    return previous
+
+
+def _restore_signal_handlers(previous: Dict[int, Any]) -> None:
+    """恢复 _install_shutdown_handlers 替换前的信号处理器"""
+    for signum, prev in previous.items():
+        signal.signal(signum, prev if prev is not None else signal.SIG_DFL)
+
+
 # ==================== WebDAV 上传 ====================
 
-def upload_to_webdav(config: Dict[str, Any], data: Any, remote_filename: str, file_size: int) -> bool:
+def resolve_upload_server(config: Dict[str, Any], conn=None) -> Optional[UploadServer]:
     """
-    上传文件到 WebDAV 服务器
-    
-    根据配置自动选择目标服务器（优先使用默认服务器），通过 HTTP PUT
-    请求将文件上传到 WebDAV。支持多服务器配置，自动回退到环境变量配置。
+    确定本次运行的上传目标服务器
+
+    每次运行只解析一次，而不是每个附件都查询一遍数据库。
     
     服务器选择逻辑:
         1. 从数据库获取所有启用的服务器
@@ -133,6 +234,96 @@ def upload_to_webdav(config: Dict[str, Any], data: Any, remote_filename: str, fi
     
     Args:
         config (Dict[str, Any]): 应用配置字典（由 load_config() 返回）
+        conn: 可选，复用调用方持有的数据库连接
+    
+    Returns:
+        Optional[UploadServer]: 目标服务器（url 已去掉末尾 '/'，并附带 auth 元组），
+            没有任何可用服务器或服务器配置无效（url 为空、timeout 非正数）时返回 None
+    """
+    from database import get_config_value, get_enabled_servers
+
+    # 从数据库获取所有启用的服务器（优先级排序）
+    servers_from_db = get_enabled_servers(conn=conn)
+    
+    # 如果数据库中没有服务器，回退到环境变量配置
+    if not servers_from_db:
+        if not config['webdav_servers']:
+            logger.error(f"{LogEmoji.ERROR} 没有配置 WebDAV 服务器，无法上传。")
+            return None
+        servers_from_db = config['webdav_servers']
+        logger.warning(f"{LogEmoji.WARNING} 数据库中没有服务器配置，使用环境变量配置")
+    
+    # 从数据库获取默认服务器名称
+    default_server_name = get_config_value('default_webdav_server', conn=conn)
+    
+    # 查找默认服务器配置
+    server = None
+    if default_server_name:
+        server = next((s for s in servers_from_db if s['name'] == default_server_name), None)
+
+    # 如果找不到默认服务器，使用第一个启用的服务器
+    if server is None:
+        server = servers_from_db[0]
+        logger.warning(f"未找到默认服务器，使用第一个启用的服务器: {server['name']}")
+
+    try:
+        return UploadServer.from_dict(server)
+    except ValueError as e:
+        logger.error(f"{LogEmoji.ERROR} 服务器配置无效，无法上传: {e}")
+        return None
+
+
+# 上传分块大小：大附件按 WEBDAV_CHUNK_SIZE（默认 256 KiB）分块写入 socket，而不是 http.client 默认的 8 KiB
+UPLOAD_CHUNK_SIZE = WEBDAV_CHUNK_SIZE
+# 小于该大小的附件直接一次性发送整个缓冲区
+STREAM_UPLOAD_THRESHOLD = 1024 * 1024
+
+
+class _ChunkedBody:
+    """
+    按固定大小分块发送的上传请求体。
+
+    提供 __len__，requests 据此设置 Content-Length 而不是使用 chunked 传输编码；
+    每次迭代都从头开始，重发请求时内容依然完整。
+    BytesIO 的内容通过 memoryview 切片发送，不复制数据；其他文件对象按块读取。
+    """
+
+    def __init__(self, fileobj, size: int, chunk_size: int = UPLOAD_CHUNK_SIZE):
+        self._fileobj = fileobj
+        self._start = fileobj.tell()
+        self._size = size
+        self._chunk_size = chunk_size
+        # BytesIO.getvalue() 在缓冲区未被修改时直接返回底层 bytes，不产生副本
+        self._view = memoryview(fileobj.getvalue()) if hasattr(fileobj, 'getvalue') else None
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        if self._view is not None:
+            view, step = self._view, self._chunk_size
+            return (view[offset:offset + step] for offset in range(self._start, len(view), step))
+        self._fileobj.seek(self._start)
+        return iter(lambda: self._fileobj.read(self._chunk_size), b'')
+
+
+def _upload_body(data: Any, file_size: int) -> Any:
+    """根据附件大小选择上传请求体：小文件直接发送整个缓冲区，大文件分块流式发送"""
+    if not hasattr(data, 'read'):
+        return data
+    if file_size < STREAM_UPLOAD_THRESHOLD and hasattr(data, 'getvalue'):
+        return data.getvalue()
+    return _ChunkedBody(data, file_size)
+
+
+def upload_to_webdav(webdav_config: UploadServer, data: Any, remote_filename: str, file_size: int) -> bool:
+    """
+    上传文件到 WebDAV 服务器
+    
+    通过 HTTP PUT 请求将文件上传到指定的 WebDAV 服务器。
+    
+    Args:
+        webdav_config (UploadServer): 目标服务器（由 resolve_upload_server() 返回）
         data (Any): 要上传的文件数据（二进制）
         remote_filename (str): 远程文件名（不含路径）
         file_size (int): 文件大小（字节）
@@ -143,17 +334,18 @@ def upload_to_webdav(config: Dict[str, Any], data: Any, remote_filename: str, fi
     Examples:
         上传文件::
         
+            server = resolve_upload_server(config)
             with open('doc.pdf', 'rb') as f:
                 data = f.read()
                 size = len(data)
-                success = upload_to_webdav(config, data, 'doc.pdf', size)
+                success = upload_to_webdav(server, data, 'doc.pdf', size)
                 if success:
                     print("上传成功")
         
         处理大文件::
         
             # 大文件会自动记录额外日志
-            upload_to_webdav(config, large_data, 'large.zip', 10*1024*1024)
+            upload_to_webdav(server, large_data, 'large.zip', 10*1024*1024)
     
     Note:
         - 文件名不应包含路径分隔符
@@ -162,47 +354,18 @@ def upload_to_webdav(config: Dict[str, Any], data: Any, remote_filename: str, fi
         - 上传结果会自动记录到 upload_logs 表
     
     Warning:
-        - 若无可用服务器配置，会返回 False
         - 网络超时会导致上传失败
         - 确保 WebDAV 服务器可访问
     
     See Also:
+        resolve_upload_server(): 选择目标服务器
         sanitize_filename(): 文件名清理
         find_unique_filename(): 处理文件名冲突
     """
-    from database import get_config_value, get_enabled_servers, get_server_by_name
-    
-    # 从数据库获取所有启用的服务器（优先级排序）
-    servers_from_db = get_enabled_servers()
-    
-    # 如果数据库中没有服务器，回退到环境变量配置
-    if not servers_from_db:
-        if not config['webdav_servers']:
-            logger.error(f"{LogEmoji.ERROR} 没有配置 WebDAV 服务器，无法上传。")
-            return False
-        servers_from_db = config['webdav_servers']
-        logger.warning(f"{LogEmoji.WARNING} 数据库中没有服务器配置，使用环境变量配置")
-    
-    # 从数据库获取默认服务器名称
-    default_server_name = get_config_value('default_webdav_server')
-    
-    # 查找默认服务器配置
-    webdav_config = None
-    if default_server_name:
-        for server in servers_from_db:
-            if server['name'] == default_server_name:
-                webdav_config = server
-                break
-    
-    # 如果找不到默认服务器，使用第一个启用的服务器
-    if not webdav_config:
-        webdav_config = servers_from_db[0]
-        logger.warning(f"未找到默认服务器，使用第一个启用的服务器: {webdav_config['name']}")
-    
     # 构建完整的 WebDAV URL
-    full_url = f"{webdav_config['url'].rstrip('/')}/{remote_filename}"
-    auth = (webdav_config['login'], webdav_config['password'])
-    server_name = webdav_config['name']
+    full_url = f"{webdav_config.url}/{remote_filename}"
+    auth = webdav_config.auth
+    server_name = webdav_config.name
 
     try:
         logger.info(f"{LogEmoji.UPLOAD} 开始上传附件到 [{server_name}]: '{remote_filename}' ({file_size / 1024:.2f} KB)")
@@ -212,10 +375,10 @@ def upload_to_webdav(config: Dict[str, Any], data: Any, remote_filename: str, fi
             logger.info(f"{LogEmoji.UPLOAD} 正在上传大文件 ({file_size / 1024 / 1024:.2f} MB),请稍候...")
 
         # 使用配置的超时时间
-        timeout = webdav_config.get('timeout', 30)
+        timeout = webdav_config.timeout
         
-        # 发送 PUT 请求上传文件
-        response = requests.put(full_url, data=data, auth=auth, timeout=timeout)
+        # 发送 PUT 请求上传文件（小文件一次发送，大文件按 UPLOAD_CHUNK_SIZE 分块发送）
+        response = _SESSION.put(full_url, data=_upload_body(data, file_size), auth=auth, timeout=timeout)
         response.raise_for_status()
 
         logger.info(f"{LogEmoji.SUCCESS} WebDAV 上传成功到 [{server_name}]: '{remote_filename}'")
@@ -227,69 +390,190 @@ def upload_to_webdav(config: Dict[str, Any], data: Any, remote_filename: str, fi
         return False
 
 
-# ==================== 文件名处理 ====================
+# ==================== 重复内容检测 ====================
 
-        # 大文件上传提示
-        if file_size > 5 * 1024 * 1024:  # > 5MB
-            logger.info(f"{LogEmoji.UPLOAD} 正在上传大文件 ({file_size / 1024 / 1024:.2f} MB),请稍候...")
+# 摘要旁路文件的后缀: 'report.pdf' 的 SHA-256 保存在 'report.pdf.sha256'
+DIGEST_SUFFIX = '.sha256'
+
+
+def content_digest(content: Any) -> str:
+    """计算附件内容的 SHA-256（BytesIO 直接对内部缓冲区计算，不复制数据）"""
+    if hasattr(content, 'getbuffer'):
+        with content.getbuffer() as view:
+            return hashlib.sha256(view).hexdigest()
+    pos = content.tell()
+    content.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: content.read(UPLOAD_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    content.seek(pos)
+    return digest.hexdigest()
+
+
+def find_duplicate_upload(server_config: UploadServer, filename: str, digest: str,
+                          existing_names: Optional[Set[str]] = None,
+                          reserved: Optional[Set[str]] = None) -> Optional[str]:
+    """
+    在服务器上的 filename 及其重命名副本（'name (1).ext'、'name (2).ext' ...）中查找内容相同的文件，
+    比较各自 '<文件名>.sha256' 中记录的摘要，返回匹配的文件名；没有则返回 None。
 
-        # 使用配置的timeout
-        timeout = webdav_config.get('timeout', 30)
-        response = requests.put(full_url, data=data, auth=auth, timeout=timeout)
+    副本按 find_unique_filename 的规则连续编号，遇到第一个不存在的文件名即停止。
+    传入 existing_names 时在目录列表中确认文件和摘要文件都存在，省去无谓的 GET；
+    否则用（运行内缓存的）HEAD 检查，并把 reserved 中本次运行已分配的文件名视为存在。
+    """
+    if existing_names is None:
+        def exists(name):
+            return (reserved is not None and name in reserved) or webdav_file_exists(server_config, name)
+
+        def has_digest(name):
+            return True  # 没有目录列表，直接请求摘要文件
+    else:
+        exists = existing_names.__contains__
+
+        def has_digest(name):
+            return name + DIGEST_SUFFIX in existing_names
+
+    name, extension = os.path.splitext(filename)
+    candidate, counter = filename, 0
+    while exists(candidate):
+        if has_digest(candidate) and _remote_digest(server_config, candidate) == digest:
+            return candidate
+        counter += 1
+        candidate = f"{name} ({counter}){extension}"
+    return None
+
+
+def _remote_digest(server_config: UploadServer, filename: str) -> Optional[str]:
+    """读取服务器上 '<文件名>.sha256' 记录的摘要；不存在或请求失败时返回 None"""
+    try:
+        response = _SESSION.get(f"{server_config.url}/{filename}{DIGEST_SUFFIX}",
+                                auth=server_config.auth, timeout=10)
+    except requests.exceptions.RequestException:
+        return None
+    return response.text.strip() if response.status_code == 200 else None
+
+
+def upload_digest(server_config: UploadServer, filename: str, digest: str) -> None:
+    """上传成功后写入摘要文件；失败只记录警告，不影响附件本身的上传结果。"""
+    try:
+        response = _SESSION.put(f"{server_config.url}/{filename}{DIGEST_SUFFIX}",
+                                data=digest.encode('ascii'), auth=server_config.auth, timeout=10)
         response.raise_for_status()
-        logger.info(f"{LogEmoji.SUCCESS} WebDAV 上传成功到 [{server_name}]: '{remote_filename}'")
-        log_upload(remote_filename, file_size, "Success", server_name)
-        return True
     except requests.exceptions.RequestException as e:
-        logger.error(f"{LogEmoji.ERROR} WebDAV 上传失败到 [{server_name}]: '{remote_filename}'。原因: {e}")
-        log_upload(remote_filename, file_size, "Failed", server_name)
-        return False
+        logger.warning(f"{LogEmoji.WARNING} 写入摘要文件失败 '{filename}{DIGEST_SUFFIX}': {e}")
+
 
+# ==================== 文件名处理 ====================
 
-def webdav_file_exists(webdav_config: Dict[str, Any], filename: str) -> bool:
+def webdav_file_exists(server_config: UploadServer, filename: str) -> bool:
     """使用 HEAD 请求检查文件是否存在于 WebDAV 服务器上。"""
-    # 注意: 这里的 webdav_config 参数实际上是整个 config 对象，需要提取第一个服务器配置
-    # 为了保持兼容性，我们在这里做处理，或者调用者应该传入具体的 server config
-    # 鉴于 find_unique_filename 传入的是全局 config，我们在这里提取
-    
-    if 'webdav_servers' in webdav_config:
-         server_config = webdav_config['webdav_servers'][0]
-    else:
-         # 假设传入的就是 server config (虽然目前代码逻辑不是这样)
-         server_config = webdav_config
-         
-    full_url = f"{server_config['url'].rstrip('/')}/{filename}"
-    auth = (server_config['login'], server_config['password'])
+    return _head_exists(f"{server_config.url}/{filename}", *server_config.auth)
+
+
+@lru_cache(maxsize=512)
+def _head_exists(full_url: str, login: str, password: str) -> bool:
+    """
+    HEAD 检查的实际实现，参数均为字符串以便 lru_cache 缓存。
+    同一次运行内重复的文件名只请求一次；process_emails 每次开始时清空缓存。
+    """
     try:
-        response = requests.head(full_url, auth=auth, timeout=10)
+        response = _SESSION.head(full_url, auth=(login, password), timeout=10)
         return response.status_code == 200
     except requests.exceptions.RequestException:
         # 在出错时假定文件不存在，以避免阻塞上传
         return False
 
 
-def find_unique_filename(config: Dict[str, Any], original_filename: str) -> str:
+# 只请求 resourcetype 一个属性（href 总会返回），避免服务器按 allprop 计算 ETag、大小等全部属性
+_PROPFIND_NAMES_BODY = (
+    b'<?xml version="1.0" encoding="utf-8"?>'
+    b'<D:propfind xmlns:D="DAV:"><D:prop><D:resourcetype/></D:prop></D:propfind>'
+)
+
+
+def list_webdav_dir(server_config: UploadServer) -> Optional[Set[str]]:
+    """
+    用一次 PROPFIND (Depth: 1) 获取上传目录中已有的文件名。
+
+    Returns:
+        Optional[Set[str]]: 已解码的文件名集合；请求或解析失败时返回 None，
+        调用方应退回逐个 HEAD 检查。
+    """
+    dir_url = f"{server_config.url}/"
+    auth = server_config.auth
+    try:
+        response = _SESSION.request('PROPFIND', dir_url, auth=auth, data=_PROPFIND_NAMES_BODY,
+                                    headers={'Depth': '1', 'Content-Type': 'application/xml; charset=utf-8'},
+                                    timeout=server_config.timeout)
+        response.raise_for_status()
+        tree = ElementTree.fromstring(response.content)
+    except (requests.exceptions.RequestException, ElementTree.ParseError) as e:
+        logger.warning(f"{LogEmoji.WARNING} 获取 WebDAV 目录列表失败，改为逐个检查文件名: {e}")
+        return None
+
+    dir_path = unquote(urlsplit(dir_url).path).rstrip('/')
+    names = set()
+    for href in tree.iter('{DAV:}href'):
+        path = unquote(urlsplit(href.text or '').path).rstrip('/')
+        if path and path != dir_path:  # 跳过目录自身
+            names.add(path.rpartition('/')[2])
+    return names
+
+
+# 并发 HEAD 检查候选文件名时每批的最大数量
+FILENAME_PROBE_BATCH_MAX = 8
+
+
+def find_unique_filename(server_config: UploadServer, original_filename: str,
+                         existing_names: Optional[Set[str]] = None,
+                         reserved: Optional[Set[str]] = None) -> str:
     """
-    在 WebDAV 服务器上查找唯一文件名以防止覆盖。
+    在目标 WebDAV 服务器上查找唯一文件名以防止覆盖。
     如果 'file.txt' 存在，它将尝试 'file (1).txt', 'file (2).txt' 等。
+
+    传入 existing_names（list_webdav_dir 的结果）时只在内存中比对，不再发起 HEAD 请求。
+    否则通过 HEAD 检查，并同时避开 reserved 中已分配但尚未上传的文件名；
+    候选名按 1、2、4、8 个一批并发检查，取每批中编号最小的可用名称。
     """
-    # webdav_file_exists 现在处理 config 提取
-    if not webdav_file_exists(config, original_filename):
+    name, extension = os.path.splitext(original_filename)
+
+    if existing_names is not None:
+        if original_filename not in existing_names:
+            return original_filename
+        counter = 1
+        while True:
+            new_filename = f"{name} ({counter}){extension}"
+            if new_filename not in existing_names:
+                logger.info(f"{LogEmoji.FILE} 文件名 '{original_filename}' 已存在。使用新名称: '{new_filename}'")
+                return new_filename
+            counter += 1
+
+    def exists(filename):
+        return (reserved is not None and filename in reserved) or webdav_file_exists(server_config, filename)
+
+    if not exists(original_filename):
         return original_filename
 
-    name, extension = os.path.splitext(original_filename)
-    counter = 1
+    counter, batch_size = 1, 1
     while True:
-        new_filename = f"{name} ({counter}){extension}"
-        if not webdav_file_exists(config, new_filename):
-            logger.info(f"{LogEmoji.FILE} 文件名 '{original_filename}' 已存在。使用新名称: '{new_filename}'")
-            return new_filename
-        counter += 1
+        candidates = [f"{name} ({i}){extension}" for i in range(counter, counter + batch_size)]
+        # 一批候选名的 HEAD 请求并发发出，K 次往返时间重叠为一次
+        for new_filename, taken in zip(candidates, _UPLOAD_POOL.map(exists, candidates)):
+            if not taken:
+                logger.info(f"{LogEmoji.FILE} 文件名 '{original_filename}' 已存在。使用新名称: '{new_filename}'")
+                return new_filename
+        counter += batch_size
+        batch_size = min(batch_size * 2, FILENAME_PROBE_BATCH_MAX)
+
+
+# 文件名中不允许出现的字符统一替换为下划线（单字符替换用 str.translate，比正则快）
+_UNSAFE_FILENAME_CHARS = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
 
 
+# 同名附件（如定期发送的 invoice.pdf）在多封邮件中反复出现，清理结果直接复用
+@lru_cache(maxsize=1024)
 def sanitize_filename(filename: str) -> str:
-    filename = filename.replace('..', '')
-    return re.sub(r'[<>:"/\\|?*]', '_', filename)
+    return filename.replace('..', '').translate(_UNSAFE_FILENAME_CHARS)
 
 
 def decode_email_header(header: Any) -> str:
@@ -299,7 +583,7 @@ def decode_email_header(header: Any) -> str:
     该函数通过以下步骤处理邮件头：
     1. 将输入转换为字符串格式
     2. 移除特定的编码前缀
-    3. 尝试进行URL解码
+    3. 进行URL解码
 
     参数:
         header (Any): 需要解码的邮件头，可能是一个特殊对象或字符串
@@ -317,24 +601,65 @@ def decode_email_header(header: Any) -> str:
         logger.error("Failed to convert header to string", exc_info=True)
         raise TypeError(f"Cannot convert header of type {type(header)} to string") from e
 
-    # 移除可能存在的编码前缀，这是最常见的问题
-    separator = "''"
-    if separator in filename_str:
-        # 只保留分隔符最后出现位置之后的部分
-        filename_str = filename_str.split(separator)[-1]
+    return _decode_filename(filename_str)
 
-    # 尝试对结果进行URL解码，因为它可能仍然被编码
-    try:
-        # unquote函数是安全的，如果没有编码内容则不会做任何处理
-        decoded_filename = unquote(filename_str)
-        return decoded_filename
-    except Exception:
-        logger.warning("Could not URL-decode input", extra={"input": filename_str}, exc_info=True)
-        # 如果解码失败，返回已清理的字符串
+
+@lru_cache(maxsize=512)
+def _decode_filename(filename_str: str) -> str:
+    """
+    decode_email_header 的实际解码步骤，按字符串缓存结果。
+
+    重试和多次运行中重复出现的文件名很常见，缓存后无需再次解码。
+    """
+    # 快速路径：没有编码前缀和百分号转义的文件名（最常见的情况）下面两步都不会改变它，直接返回
+    if "''" not in filename_str and "%" not in filename_str:
         return filename_str
 
+    # 移除可能存在的编码前缀（RFC 2231 的 charset''value），这是最常见的问题：
+    # 只保留分隔符最后出现位置之后的部分；rpartition 一次扫描完成，不存在分隔符时原样返回
+    filename_str = filename_str.rpartition("''")[2]
+
+    # 对结果进行URL解码，因为它可能仍然被编码；
+    # unquote 对 str 使用 errors='replace'，无效的转义序列会被替换而不会抛出异常，无需 try/except
+    return unquote(filename_str)
 
-def _process_single_message(imbox: Imbox, uid: bytes, message: Any, config: Dict[str, Any]) -> bool:
+
+def _attachment_size(attachment: Dict[str, Any], content: Any) -> int:
+    """
+    获取附件大小（字节）。
+
+    imbox 解析附件时已经记录了解码后的长度 ('size')，直接使用；
+    否则按 BytesIO 缓冲区长度计算，最后才对其他文件对象 seek 到末尾。
+    """
+    size = attachment.get('size')
+    if size is not None:
+        return size
+    if hasattr(content, 'getbuffer'):
+        return content.getbuffer().nbytes
+    pos = content.tell()
+    size = content.seek(0, 2)
+    content.seek(pos)
+    return size
+
+
+# 进程级上传线程池: 线程在首次提交时才创建，之后所有邮件复用，不再每封邮件新建线程池
+_UPLOAD_POOL = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='webdav-upload')
+
+
+def _process_single_message(imbox: Imbox, uid: bytes, message: Any, webdav_config: UploadServer,
+                            existing_names: Optional[Set[str]] = None,
+                            reserved: Optional[Set[str]] = None,
+                            run_digests: Optional[Dict[str, str]] = None) -> bool:
+    """
+    上传一封邮件的全部附件。
+
+    reserved 是本次运行中已分配（已上传或即将上传）的文件名集合，必须在整个运行内共用：
+    没有目录列表时 HEAD 结果会在运行内缓存，只有靠它才能避开前面邮件刚上传的同名文件。
+    run_digests 记录本次运行已成功上传的内容摘要 {摘要: 文件名}（同样在运行内共用），
+    前面邮件中内容相同的附件不会在其摘要文件写入之前被重复上传；只在上传成功后记录，
+    上传失败的内容在后面的邮件中仍会上传。同一邮件内的重复附件在分配文件名时即跳过
+    （其中任一上传失败整封邮件都会保留，下次运行重试）。
+    """
     uid_str = uid.decode()
 
     attachments = message.attachments
@@ -345,7 +670,13 @@ def _process_single_message(imbox: Imbox, uid: bytes, message: Any, config: Dict
         logger.warning(f"{LogEmoji.WARNING} [UID: {uid_str}] 确认没有附件，跳过。")
         return True
 
-    all_attachments_succeeded = True
+    # 第一步（串行）: 解码文件名、检查大小并分配唯一文件名，保证并行上传时不会重名
+    if reserved is None:
+        reserved = existing_names if existing_names is not None else set()
+    if run_digests is None:
+        run_digests = {}
+    message_digests = {}  # 本邮件中已分配上传的摘要
+    upload_tasks = []
     for index, attachment in enumerate(attachments):
         original_filename_raw = attachment.get('filename')
         logger.info(
@@ -357,20 +688,8 @@ def _process_single_message(imbox: Imbox, uid: bytes, message: Any, config: Dict
             safe_filename = sanitize_filename(original_filename)
             logger.info(f"{LogEmoji.SUCCESS} [UID: {uid_str}] 解码和清理后文件名: '{safe_filename}'")
 
-            # 查找唯一文件名以避免冲突
-            final_filename = find_unique_filename(config, safe_filename)
-
             attachment_content = attachment.get('content')
-
-            # 检查附件大小 (不读取整个文件到内存)
-            if hasattr(attachment_content, 'getbuffer'):
-                attachment_size = attachment_content.getbuffer().nbytes
-            else:
-                # Fallback for other file-like objects
-                pos = attachment_content.tell()
-                attachment_content.seek(0, 2)
-                attachment_size = attachment_content.tell()
-                attachment_content.seek(pos)
+            attachment_size = _attachment_size(attachment, attachment_content)
 
             if attachment_size > MAX_ATTACHMENT_SIZE:
                 logger.warning(
@@ -379,15 +698,309 @@ def _process_single_message(imbox: Imbox, uid: bytes, message: Any, config: Dict
                 )
                 continue
 
-            if not upload_to_webdav(config, attachment_content, final_filename, attachment_size):
-                all_attachments_succeeded = False
-                logger.warning(f"{LogEmoji.WARNING} [UID: {uid_str}] -> 附件 '{original_filename}' 上传失败，此邮件将不会被删除。")
-                break
+            digest = None
+            if UPLOAD_SKIP_DUPLICATES:
+                digest = content_digest(attachment_content)
+                duplicate = message_digests.get(digest) or run_digests.get(digest) or find_duplicate_upload(
+                    webdav_config, safe_filename, digest, existing_names, reserved)
+                if duplicate:
+                    logger.info(f"{LogEmoji.INFO} [UID: {uid_str}] 服务器上已有内容相同的 '{duplicate}'，跳过上传")
+                    log_upload(safe_filename, attachment_size, "Skipped", webdav_config.name)
+                    continue
+
+            # 查找唯一文件名以避免冲突，并立即占用该名称
+            final_filename = find_unique_filename(webdav_config, safe_filename, existing_names, reserved)
+            reserved.add(final_filename)
+            if digest:
+                message_digests[digest] = final_filename
+                reserved.add(final_filename + DIGEST_SUFFIX)  # 让本次运行后续的同名附件也能比对摘要
+            upload_tasks.append((original_filename, attachment_content, final_filename, attachment_size, digest))
         except Exception as e:
             logger.error(f"{LogEmoji.ERROR} [UID: {uid_str}] 处理附件 '{original_filename}' 时发生内部错误: {e}", exc_info=True)
-            all_attachments_succeeded = False
+            return False
+
+    if not upload_tasks:
+        return True
+
+    # 第二步（并行）: 上传附件，PUT 请求互相重叠
+    def upload(task):
+        original_filename, attachment_content, final_filename, attachment_size, digest = task
+        try:
+            if upload_to_webdav(webdav_config, attachment_content, final_filename, attachment_size):
+                if digest:
+                    upload_digest(webdav_config, final_filename, digest)
+                    run_digests[digest] = final_filename
+                return True
+            logger.warning(f"{LogEmoji.WARNING} [UID: {uid_str}] -> 附件 '{original_filename}' 上传失败，此邮件将不会被删除。")
+        except Exception as e:
+            logger.error(f"{LogEmoji.ERROR} [UID: {uid_str}] 上传附件 '{original_filename}' 时发生内部错误: {e}", exc_info=True)
+        return False
+
+    if len(upload_tasks) == 1:
+        return upload(upload_tasks[0])
+    # 等待全部上传结束再返回，避免邮件处理结果确定后仍有上传在后台进行
+    return all(list(_UPLOAD_POOL.map(upload, upload_tasks)))
+
+
+def _search_unread_uids(imbox: Imbox, subject: str) -> List[bytes]:
+    """
+    用一条 UID SEARCH 查找主题包含 subject 的未读邮件，返回 UID 列表。
+
+    查询条件与 imbox.messages(unread=True, subject=...) 相同（主题中的双引号替换为单引号），
+    但不依赖 imbox 内部的 Messages 对象。
+    """
+    query = '(UNSEEN) (SUBJECT "{}")'.format(subject.replace('"', "'"))
+    typ, data = imbox.connection.uid('SEARCH', None, query)
+    if typ != 'OK' or not data or not data[0]:
+        return []
+    return data[0].split()
+
+
+# BODYSTRUCTURE 中出现任一标记都可能带附件，必须下载正文交给 imbox 解析
+_ATTACHMENT_HINTS = (b'"ATTACHMENT"', b'"INLINE"', b'"FILENAME"', b'"NAME"')
+_FETCH_PREFIX_RE = re.compile(rb'^\d+ \(')
+
+
+def _skip_fetch_value(data: bytes, i: int) -> int:
+    """返回从 data[i] 开始的一个 FETCH 值（原子、带引号字符串、{n} 字面量或括号列表）之后的位置。"""
+    depth = 0
+    n = len(data)
+    while i < n:
+        c = data[i]
+        if c == 0x22:  # "：跳过带引号字符串，处理反斜杠转义
+            i += 1
+            while i < n and data[i] != 0x22:
+                i += 2 if data[i] == 0x5C else 1
+            i += 1
+        elif c == 0x7B:  # {n}：字面量内容紧跟在 } 之后，按长度整体跳过
+            end = data.find(b'}', i)
+            if end < 0 or not data[i + 1:end].isdigit():
+                return n
+            i = end + 1 + int(data[i + 1:end])
+        elif c in (0x28, 0x5B):  # ( [
+            depth += 1
+            i += 1
+        elif c in (0x29, 0x5D):  # ) ]
+            if depth == 0:
+                return i
+            depth -= 1
+            i += 1
+        elif c == 0x20 and depth == 0:
+            return i
+        else:
+            i += 1
+    return i
+
+
+def _fetch_items(data: bytes) -> Dict[bytes, bytes]:
+    """
+    解析 FETCH 响应顶层的 "名称 值" 数据项，返回 {大写名称: 原始值}。
+
+    data 可以是完整响应 "<序号> (...)"，也可以是字面量之后的后续片段。
+    括号、带引号字符串和字面量中的内容不会被当成数据项，
+    文件名或 BODYSTRUCTURE 中出现的 "UID 123" 之类文本不会被误认成 UID。
+    """
+    prefix = _FETCH_PREFIX_RE.match(data)
+    i = prefix.end() if prefix else 0
+    tokens = []
+    while i < len(data):
+        if data[i] in b' \r\n':
+            i += 1
+        elif data[i] == 0x29:
             break
-    return all_attachments_succeeded
+        else:
+            end = max(_skip_fetch_value(data, i), i + 1)
+            tokens.append(data[i:end])
+            i = end
+    return {tokens[k].upper(): tokens[k + 1] for k in range(0, len(tokens) - 1, 2)}
+
+
+def _prefetch_structure(imbox: Imbox, uids: List[bytes]) -> Tuple[Set[bytes], Dict[bytes, int]]:
+    """
+    用一条 UID FETCH (RFC822.SIZE BODYSTRUCTURE) 预检所有邮件的大小和结构（不下载正文），
+    返回 (确定没有附件的 UID 集合, {UID: 邮件原始大小})。
+
+    附件判断是保守的：结构里出现任何附件、内联或文件名标记就视为可能有附件；
+    预检失败或响应无法识别时返回空集合和空字典，所有邮件照常完整下载（逐封，不预取）。
+    """
+    try:
+        typ, data = imbox.connection.uid('FETCH', b','.join(uids), '(RFC822.SIZE BODYSTRUCTURE)')
+    except Exception as e:
+        logger.warning(f"{LogEmoji.WARNING} 预取邮件结构失败，将逐封完整下载: {e}")
+        return set(), {}
+    if typ != 'OK':
+        return set(), {}
+
+    # 每封邮件的响应以 "<序号> (" 开头；带字面量（如非 ASCII 文件名）时会拆成 tuple + 后续片段
+    records = []
+    for item in data:
+        if isinstance(item, tuple):
+            chunk = b''.join(item)
+        elif isinstance(item, bytes):
+            chunk = item
+        else:
+            continue
+        if not records or chunk[:1].isdigit():
+            records.append(chunk)
+        else:
+            records[-1] += chunk
+
+    without, sizes = set(), {}
+    for record in records:
+        items = _fetch_items(record)
+        uid = items.get(b'UID')
+        if not uid or not uid.isdigit():
+            continue
+        size = items.get(b'RFC822.SIZE')
+        if size and size.isdigit():
+            sizes[uid] = int(size)
+        structure = items.get(b'BODYSTRUCTURE')
+        if structure is not None and not any(hint in structure.upper() for hint in _ATTACHMENT_HINTS):
+            without.add(uid)
+    return without, sizes
+
+
+# 每条 UID FETCH 批量下载的邮件正文数量（同时不超过本次运行剩余的处理额度）
+FETCH_BATCH_SIZE = 5
+
+# 已下载但尚未处理的邮件（含正在处理的这封）原始大小之和的上限（字节）。
+# 解析后每封邮件同时持有原始文本、MIME 树和解码后的附件，内存占用是原始大小的数倍；
+# 超出时不再预取，大邮件逐封下载，峰值内存仍接近单封邮件
+PREFETCH_MAX_BYTES = 20 * 1024 * 1024
+
+
+def _fetch_messages(imbox: Imbox, uids: List[bytes], parser_policy: Any = None) -> Dict[bytes, Any]:
+    """
+    用一条 UID FETCH (BODY.PEEK[]) 批量下载多封邮件并用 imbox 的解析器解析，返回 {uid: message}。
+
+    BODY.PEEK 不会把邮件标记为已读，与 imbox 逐封获取时的行为一致。
+    """
+    typ, data = imbox.connection.uid('FETCH', b','.join(uids), '(BODY.PEEK[])')
+    if typ != 'OK':
+        return {}
+
+    # 每封邮件是一个 (响应头, 正文) tuple，后面跟着闭合片段；UID 可能出现在正文之前或之后
+    messages = {}
+    pending = None
+    for item in data:
+        if isinstance(item, tuple):
+            uid = _fetch_items(item[0]).get(b'UID')
+            if uid:
+                messages[uid] = parse_email(item[1], policy=parser_policy)
+            else:
+                pending = item[1]
+        elif pending is not None and isinstance(item, bytes):
+            uid = _fetch_items(item).get(b'UID')
+            if uid:
+                messages[uid] = parse_email(pending, policy=parser_policy)
+            pending = None
+    return messages
+
+
+class _MessagePrefetcher:
+    """
+    按处理顺序提供邮件，并在当前邮件处理（上传）期间由后台线程下载后面的邮件（双缓冲），
+    让 IMAP 下载与 WebDAV 上传重叠进行。
+
+    预取按邮件原始大小（RFC822.SIZE）限量：内存中的邮件（正在处理的、已下载的和下载中的）
+    合计不超过 PREFETCH_MAX_BYTES；大小未知的邮件只在需要时单独下载。
+    IMAP 连接同一时刻只有一个线程在用：前台需要邮件时总是先等待后台批次完成，
+    close() 之后连接才可用于删除邮件。
+    """
+
+    def __init__(self, imbox: Imbox, uids: List[bytes], skip: Set[bytes], sizes: Dict[bytes, int]):
+        self._imbox = imbox
+        self._policy = getattr(imbox, 'parser_policy', None)
+        self._uids = uids    # 本次运行的全部 UID，顺序与处理顺序一致
+        self._skip = skip    # 无需下载正文的 UID（同样计入处理额度）
+        self._sizes = sizes  # 邮件原始大小，预取时据此限量
+        self._pos = 0        # _uids[:_pos] 已下载或已确定无需下载
+        self._ready = {}
+        self._future = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='imap-fetch')
+
+    def _size(self, uid: bytes) -> int:
+        # 大小未知时按占满整个额度计算，保证它只会被单独下载
+        return self._sizes.get(uid, PREFETCH_MAX_BYTES)
+
+    def _take(self, count: int, max_bytes: int, at_least_one: bool) -> List[bytes]:
+        """
+        向后覆盖至多 count 封邮件，返回其中需要下载正文的 UID，其原始大小合计不超过 max_bytes。
+        at_least_one 为 True 时（前台下载）即使超出也至少返回一封。
+        """
+        end, limit = self._pos, min(self._pos + count, len(self._uids))
+        batch, total = [], 0
+        while end < limit:
+            uid = self._uids[end]
+            if uid not in self._skip:
+                size = self._size(uid)
+                if total + size > max_bytes and (batch or not at_least_one):
+                    break
+                batch.append(uid)
+                total += size
+            end += 1
+        self._pos = end
+        return batch
+
+    def get(self, position: int, budget: int) -> Any:
+        """
+        返回 _uids[position] 对应的邮件（无法获取时返回 None）。budget 是本次运行还需成功处理的邮件数（含当前这封），
+        预取范围不会超过它，达到处理上限时不会多下载用不到的邮件。
+        """
+        uid = self._uids[position]
+        if uid not in self._ready and self._future is not None:
+            self._ready.update(self._future.result())
+            self._future = None
+        if uid not in self._ready and self._pos <= position:
+            self._pos = position
+            batch = self._take(max(1, min(FETCH_BATCH_SIZE, budget)), PREFETCH_MAX_BYTES, True)
+            self._ready.update(_fetch_messages(self._imbox, batch, self._policy))
+
+        message = self._ready.pop(uid, None)
+        if message is None:
+            # 批量响应中缺少该邮件时单独再取一次（同样的 FETCH + 解析，返回同类对象）；仍然没有则返回 None
+            message = _fetch_messages(self._imbox, [uid], self._policy).get(uid)
+
+        ahead = budget - (self._pos - position)
+        if self._future is None and ahead > 0 and self._pos < len(self._uids):
+            held = self._size(uid) + sum(self._size(ready_uid) for ready_uid in self._ready)
+            batch = self._take(min(FETCH_BATCH_SIZE, ahead), PREFETCH_MAX_BYTES - held, False)
+            if batch:
+                self._future = self._executor.submit(
+                    _fetch_messages, self._imbox, batch, self._policy)
+        return message
+
+    def close(self) -> None:
+        """等待进行中的后台下载结束并丢弃未处理的邮件"""
+        self._executor.shutdown(wait=True)
+        self._future = None
+        self._ready.clear()
+
+
+def _release_attachments(message: Any) -> None:
+    """
+    关闭邮件附件的 BytesIO，立即释放解码后的附件内容。
+
+    上传已经直接从这些缓冲区流式发送（见 _upload_body），处理完后不再需要；
+    不释放的话，它们要等到下一封邮件 FETCH 完成、旧邮件对象被回收时才释放，峰值内存是两封邮件之和。
+    """
+    for attachment in getattr(message, 'attachments', None) or ():
+        content = attachment.get('content')
+        if content is not None and hasattr(content, 'close'):
+            content.close()
+
+
+def _delete_messages(imbox: Imbox, uids: List[bytes]) -> None:
+    """
+    用一条 UID STORE 命令给所有邮件打上 \\Deleted 标记，再统一 EXPUNGE 一次。
+
+    imbox.delete() 每封邮件都会单独 STORE + EXPUNGE，批量处理可省去 (N-1) 次往返。
+    """
+    if not uids:
+        return
+    imbox.connection.uid('STORE', b','.join(uids), '+FLAGS', '(\\Deleted)')
+    imbox.connection.expunge()
+    logger.info(f"{LogEmoji.SUCCESS} 已批量删除 {len(uids)} 封处理完成的邮件。")
 
 
 def process_emails() -> None:
@@ -399,11 +1012,20 @@ def process_emails() -> None:
     logger.info("=" * 40)
     logger.info(f"{LogEmoji.INFO} 开始执行邮件检查任务...")
 
-    if not acquire_lock(LOCK_NAME):
+    # 本次运行共用一个数据库连接：持有命名锁（锁绑定在会话上），并用于查询目标服务器
+    conn = get_db_connection()
+    if not conn:
+        logger.error(f"{LogEmoji.ERROR} 无法连接数据库，跳过此次执行。")
+        logger.info("=" * 40)
+        return
+
+    if not acquire_lock(LOCK_NAME, conn):
+        conn.close()
         logger.info(f"{LogEmoji.WARNING} 另一个邮件检查任务正在运行。跳过此次执行。")
         logger.info("=" * 40)
         return
 
+    previous_handlers = _install_shutdown_handlers()
     try:
         config = load_config()
         if not validate_config(config):
@@ -412,53 +1034,102 @@ def process_emails() -> None:
         imap_config = config['imap']
         search_subject = config['email']['search_subject']
 
+        # HEAD 结果只在单次运行内有效
+        _head_exists.cache_clear()
+
+        # 上传目标服务器每次运行只解析一次
+        webdav_config = resolve_upload_server(config, conn=conn)
+        if not webdav_config:
+            return
+
         with Imbox(imap_config['hostname'],
                    username=imap_config['username'],
                    password=imap_config['password'],
                    ssl=True) as imbox:
             logger.info(f"{LogEmoji.SUCCESS} 成功连接到邮箱 {imap_config['hostname']}。")
             logger.info(f"{LogEmoji.EMAIL} 开始搜索主题为 '{search_subject}' 的未读邮件...")
-            unread_messages = imbox.messages(unread=True, subject=search_subject)
+            uids = _search_unread_uids(imbox, search_subject)
 
-            if not unread_messages:
+            if not uids:
                 logger.info(f"{LogEmoji.INFO} 没有找到主题为 '{search_subject}' 的新邮件。")
                 return
 
-            logger.info(f"{LogEmoji.EMAIL} 找到 {len(unread_messages)} 封相关邮件,开始处理...")
-
-            processed_count = 0
-            for uid, message in unread_messages:
-                # 批量处理限制
-                if processed_count >= MAX_EMAILS_PER_RUN:
-                    logger.info(
-                        f"{LogEmoji.INFO} 已处理 {MAX_EMAILS_PER_RUN} 封邮件,剩余邮件将在下次运行时处理"
-                    )
-                    break
+            # 正文由下面的循环按需批量 FETCH
+            total_count = len(uids)
+            logger.info(f"{LogEmoji.EMAIL} 找到 {total_count} 封相关邮件,开始处理...")
 
-                uid_str = uid.decode()
-                logger.info("-" * 40)
-                logger.info(f"{LogEmoji.EMAIL} 正在处理邮件 - UID: {uid_str}, 主题: '{message.subject}'")
+            # 先只取邮件大小和结构，没有附件的邮件无需下载正文，大小用于限制预取量
+            without_attachments, message_sizes = _prefetch_structure(imbox, uids)
 
-                # --- 关键改动: 不再立即标记为已读，依赖数据库锁防止并发 ---
-                # imbox.mark_seen(uid)
-                # logger.info(f"[UID: {uid_str}] 已立即标记为已读，以防止重复处理。")
+            # 目录列表每次运行只获取一次，之后的重名检查都在内存中完成
+            existing_names = list_webdav_dir(webdav_config)
+            # 本次运行已分配的文件名；没有目录列表时跨邮件共用，避免覆盖前面邮件刚上传的同名文件
+            reserved_names = existing_names if existing_names is not None else set()
+            uploaded_digests = {}
 
-                if _process_single_message(imbox, uid, message, config):
-                    imbox.delete(uid)
-                    logger.info(f"{LogEmoji.SUCCESS} [UID: {uid_str}] 邮件已成功处理并删除。")
-                    processed_count += 1
-                else:
-                    # 如果处理失败,邮件将保持已读状态,不会在下次被获取
-                    logger.error(f"{LogEmoji.ERROR} [UID: {uid_str}] 邮件处理失败,将保持已读状态但不会被删除。")
+            processed_count = 0
+            processed_uids = []
+            prefetcher = _MessagePrefetcher(imbox, uids, without_attachments, message_sizes)
+            try:
+                for index, uid in enumerate(uids, 1):
+                    if _SHUTDOWN.is_set():
+                        logger.warning(f"{LogEmoji.WARNING} 收到退出信号，停止处理剩余邮件。")
+                        break
+
+                    uid_str = uid.decode()
+                    logger.info("-" * 40)
+
+                    if uid in without_attachments:
+                        processed_uids.append(uid)
+                        logger.warning(f"{LogEmoji.WARNING} [UID: {uid_str}] 邮件结构中没有附件，跳过下载，将在本轮结束后删除。")
+                        processed_count += 1
+                    else:
+                        message = prefetcher.get(index - 1, MAX_EMAILS_PER_RUN - processed_count)
+                        if message is None:
+                            logger.error(f"{LogEmoji.ERROR} [UID: {uid_str}] 无法下载邮件正文，此邮件将不会被删除。")
+                            continue
+                        logger.info(f"{LogEmoji.EMAIL} 正在处理邮件 - UID: {uid_str}, 主题: '{message.subject}'")
+
+                        # --- 关键改动: 不再立即标记为已读，依赖数据库锁防止并发 ---
+                        # imbox.mark_seen(uid)
+                        # logger.info(f"[UID: {uid_str}] 已立即标记为已读，以防止重复处理。")
+
+                        succeeded = _process_single_message(imbox, uid, message, webdav_config,
+                                                            existing_names, reserved_names, uploaded_digests)
+                        _release_attachments(message)
+                        message = None
+                        if succeeded:
+                            processed_uids.append(uid)
+                            logger.info(f"{LogEmoji.SUCCESS} [UID: {uid_str}] 邮件已成功处理，将在本轮结束后删除。")
+                            processed_count += 1
+                        else:
+                            # 如果处理失败,邮件将保持已读状态,不会在下次被获取
+                            logger.error(f"{LogEmoji.ERROR} [UID: {uid_str}] 邮件处理失败,将保持已读状态但不会被删除。")
+
+                    # 批量处理限制: 达到上限后立即停止，避免再多 FETCH 一封用不到的邮件
+                    if processed_count >= MAX_EMAILS_PER_RUN:
+                        if index < total_count:
+                            logger.info(
+                                f"{LogEmoji.INFO} 已处理 {MAX_EMAILS_PER_RUN} 封邮件,剩余邮件将在下次运行时处理"
+                            )
+                        break
+            finally:
+                # 先等后台下载结束，IMAP 连接空闲后再删除邮件
+                prefetcher.close()
+                # 即使中途出错，已处理成功的邮件也要删除，避免下次重复上传
+                _delete_messages(imbox, processed_uids)
 
             if processed_count > 0:
                 logger.info(f"{LogEmoji.SUCCESS} 本次执行共成功处理 {processed_count} 封邮件。")
-    except (errno.ConnectionError, OSError) as e:
+    except (ConnectionError, OSError) as e:
         logger.error(f"{LogEmoji.ERROR} 连接或处理邮箱时发生严重错误: {e}")
     except Exception as e:
         logger.error(f"{LogEmoji.ERROR} 发生未知错误: {e}", exc_info=True)
     finally:
-        release_lock(LOCK_NAME)
+        _restore_signal_handlers(previous_handlers)
+        flush_logs()  # 等待本次运行的上传日志全部写入，必须在释放锁之前完成
+        release_lock(LOCK_NAME, conn)
+        conn.close()
         logger.info(f"{LogEmoji.INFO} 邮件检查任务执行完毕。")
         logger.info("=" * 40)
 
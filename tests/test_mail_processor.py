@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+mail_processor 附件上传流程的测试
+
+WebDAV 服务器由内存中的假会话代替，上传日志不写数据库。
+运行: python -m unittest discover -s tests
+"""
+import io
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mail_processor  # noqa: E402
+
+
+class _Response:
+    def __init__(self, status_code, text=''):
+        self.status_code = status_code
+        self.text = text
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise mail_processor.requests.exceptions.HTTPError(f"{self.status_code}")
+
+
+class _FakeWebDav:
+    """按文件名保存内容的假 WebDAV 会话；fail_puts 中的文件名第一次 PUT 返回 500"""
+
+    def __init__(self, fail_puts=()):
+        self.files = {}
+        self.puts = []
+        self.fail_puts = set(fail_puts)
+
+    def _name(self, url):
+        return url.rsplit('/', 1)[1]
+
+    def head(self, url, **kwargs):
+        return _Response(200 if self._name(url) in self.files else 404)
+
+    def get(self, url, **kwargs):
+        name = self._name(url)
+        return _Response(200, self.files[name]) if name in self.files else _Response(404)
+
+    def put(self, url, data=None, **kwargs):
+        name = self._name(url)
+        self.puts.append(name)
+        if name in self.fail_puts:
+            self.fail_puts.discard(name)
+            return _Response(500)
+        self.files[name] = data.decode() if isinstance(data, bytes) else 'content'
+        return _Response(201)
+
+
+class _Message:
+    def __init__(self, *attachments):
+        self.attachments = [
+            {'filename': name, 'content': io.BytesIO(content), 'size': len(content)}
+            for name, content in attachments
+        ]
+
+
+class DuplicateUploadTest(unittest.TestCase):
+    def setUp(self):
+        mail_processor._head_exists.cache_clear()
+        self.server = mail_processor.UploadServer.from_dict(
+            {'name': 'Test', 'url': 'http://webdav.test/dav', 'login': 'user', 'password': 'secret'})
+        self.logs = []
+        patches = [
+            mock.patch.object(mail_processor, 'UPLOAD_SKIP_DUPLICATES', True),
+            mock.patch.object(mail_processor, 'log_upload',
+                              lambda filename, size, status, server=None: self.logs.append((filename, status))),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _process(self, webdav, uid, message, reserved, run_digests):
+        with mock.patch.object(mail_processor, '_SESSION', webdav):
+            return mail_processor._process_single_message(
+                None, uid, message, self.server, None, reserved, run_digests)
+
+    def test_failed_upload_is_not_treated_as_duplicate(self):
+        webdav = _FakeWebDav(fail_puts={'a.pdf'})
+        reserved, run_digests = set(), {}
+
+        first = self._process(webdav, b'1', _Message(('a.pdf', b'same')), reserved, run_digests)
+        second = self._process(webdav, b'2', _Message(('a.pdf', b'same')), reserved, run_digests)
+
+        self.assertFalse(first)
+        self.assertTrue(second)
+        self.assertNotIn(('a.pdf', 'Skipped'), self.logs)
+        self.assertIn('a (1).pdf', webdav.files)
+
+    def test_successful_upload_skips_later_duplicate(self):
+        webdav = _FakeWebDav()
+        reserved, run_digests = set(), {}
+
+        self.assertTrue(self._process(webdav, b'1', _Message(('a.pdf', b'same')), reserved, run_digests))
+        self.assertTrue(self._process(webdav, b'2', _Message(('b.pdf', b'same')), reserved, run_digests))
+
+        self.assertEqual([name for name in webdav.puts if not name.endswith('.sha256')], ['a.pdf'])
+        self.assertIn(('b.pdf', 'Skipped'), self.logs)
+
+
+class _FakeImapConnection:
+    def __init__(self, data):
+        self.data = data
+
+    def uid(self, command, *args):
+        return 'OK', self.data
+
+
+class _FakeImbox:
+    def __init__(self, data):
+        self.connection = _FakeImapConnection(data)
+
+
+class PrefetchStructureTest(unittest.TestCase):
+    def test_uid_text_inside_bodystructure_is_ignored(self):
+        imbox = _FakeImbox([
+            b'1 (BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "UID 99") NIL NIL "7BIT" 10 1) RFC822.SIZE 120 UID 7)',
+            (b'2 (UID 8 RFC822.SIZE 300 BODYSTRUCTURE (("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1)'
+             b'("APPLICATION" "PDF" ("NAME" {6}', b'UID 99'),
+            b') NIL NIL "BASE64" 100) "MIXED"))',
+        ])
+
+        without, sizes = mail_processor._prefetch_structure(imbox, [b'7', b'8'])
+
+        self.assertEqual(without, {b'7'})
+        self.assertEqual(sizes, {b'7': 120, b'8': 300})
+
+
+if __name__ == '__main__':
+    unittest.main()